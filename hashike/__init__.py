@@ -1,9 +1,23 @@
 __version__ = '0.0.0'
 
+from typing import TYPE_CHECKING, Any
+
 from .cli import main
-from .core import ApplyResult, apply
+
+if TYPE_CHECKING:
+    from .core import ApplyResult, apply
 
 __all__ = ['ApplyResult', 'apply']
 
+
+def __getattr__(name: str) -> Any:
+    # CLI の起動を軽くするため、core (とドライバ) は初回アクセス時に読み込む
+    if name in __all__:
+        from . import core
+        return getattr(core, name)
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
 if __name__ == '__main__':
     main()
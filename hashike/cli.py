@@ -1,18 +1,15 @@
 import argparse
-import importlib
 import io
 import logging.config
 import sys
-import traceback
 from pathlib import Path
 from types import ModuleType
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
-import yaml
+from .utils import URL, default_network, get_language, open_url, package_name
 
-from .core import apply, default_network
-from .drivers import Driver, get_driver
-from .utils import URL, get_language, open_url, package_name
+if TYPE_CHECKING:
+    from .drivers import Driver
 
 DEFAULT_DRIVER = 'docker'
 
@@ -45,13 +42,18 @@ logger = logging.getLogger(package_name)
 
 
 def parse_import_module(s: str) -> ModuleType:
+    import importlib
+
     try:
         return importlib.import_module(s)
     except ModuleNotFoundError as e:
         raise argparse.ArgumentTypeError(str(e))
 
 
-def parse_driver(s: str) -> Driver:
+def parse_driver(s: str) -> 'Driver':
+    # ドライバモジュールの読み込みは、実際にドライバを解決する時まで遅延させる
+    from .drivers import get_driver
+
     try:
         return get_driver(s)
     except KeyError:
@@ -73,11 +75,18 @@ def parse_file(s: str):
 
 
 def parse_log_config(s: str) -> dict[str, Any]:
+    import traceback
+
+    import yaml
+
+    # libyaml があれば C 実装のローダーを使用する
+    yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
     url = parse_url(s)
 
     try:
         with open_url(url, encoding='utf8') as f:
-            return yaml.safe_load(f)
+            return yaml.load(f.read(), Loader=yaml_loader)
     except Exception:
         raise argparse.ArgumentTypeError(f"""
 failed to open, for the following reasons:
@@ -85,67 +94,86 @@ failed to open, for the following reasons:
 """.strip())
 
 
-def get_local_helps() -> dict[str, str]:
-    r: dict[str, str] = {}
-
-    lang = get_language()
-
-    if lang == 'ja':
-        r['--driver'] = """
+_ja_helps = {
+    '--driver': """
 コンテナドライバ。現在は "docker" のみ。省略した場合のデフォルトも "docker"
-"""
-        r['--network'] = f"""
+""",
+    '--network': f"""
 コンテナが接続する既存のネットワーク。オプション繰り返しによる複数指定可。
 未指定の場合、デフォルトの "{default_network}" を作成し、接続する
-"""
-        r['--log-config'] = """
+""",
+    '--log-config': """
 ロギング設定。logging.dictConfig() で読み込むため JSON と YAML のみ対応
-"""
-        r['--import-module'] = """
+""",
+    '--import-module': """
 追加でインポートするモジュール。オプション繰り返しによる複数指定可。
 もし、カスタムドライバを使用する場合 --driver より先に指定する必要がある
-"""
-        r['file'] = """
+""",
+    'file': """
 K8s Pod マニフェストに似たコンテナ定義ファイル。標準入力から取り込むなら "-" を指定する
 """
-        r = {k: v.replace('\n', '') for k, v in r.items()}
-    else:
-        r['--driver'] = 'container driver (default: "%(default)s")'
-        r['--network'] = 'existing container network(s)'
-        r['--log-config'] = ('logging configuration (supported formats: json, '
-                             'yaml)')
-        r['--import-module'] = ('pre-import modules (if a custom driver is '
-                                'used, it must be before --driver)')
-        r['file'] = ('container definition file like K8s manifest. '
-                     '(if reading from standard input, '
-                     'specify "-" as the input source)')
+}
+# 改行は起動毎ではなく、読み込み時に一度だけ取り除く
+_newline_table = str.maketrans('', '', '\n')
+_ja_helps = {k: v.translate(_newline_table) for k, v in _ja_helps.items()}
+
+_en_helps = {
+    '--driver': 'container driver (default: "%(default)s")',
+    '--network': 'existing container network(s)',
+    '--log-config': 'logging configuration (supported formats: json, yaml)',
+    '--import-module': ('pre-import modules (if a custom driver is used, '
+                        'it must be before --driver)'),
+    'file': ('container definition file like K8s manifest. '
+             '(if reading from standard input, '
+             'specify "-" as the input source)')
+}
+
 
-    return r
+def get_local_helps() -> dict[str, str]:
+    if get_language() == 'ja':
+        return _ja_helps
 
+    return _en_helps
 
-def main() -> None:
+
+def build_apply_parser(parser: argparse.ArgumentParser) -> None:
     helps = get_local_helps()
 
+    parser.add_argument('--driver', type=parse_driver, default=DEFAULT_DRIVER,
+                        help=helps['--driver'])
+    parser.add_argument('--network', action='append', dest='networks',
+                        metavar='NETWORK', help=helps['--network'])
+    parser.add_argument('--log-config', type=parse_log_config,
+                        default=default_log_config,
+                        help=helps['--log-config'])
+    parser.add_argument('--import-module', type=parse_import_module,
+                        action='append', dest='import_modules',
+                        metavar='MODULE', help=helps['--import-module'])
+    parser.add_argument('file', type=parse_file, help=helps['file'])
+
+
+subcommand_builders = {
+    'apply': build_apply_parser
+}
+
+
+def main() -> None:
     parser = argparse.ArgumentParser(Path(__file__).parent.name)
 
     subparsers = parser.add_subparsers(dest='subcommand', required=True)
-    subparser = subparsers.add_parser('apply')
-    subparser.add_argument('--driver', type=parse_driver,
-                           default=get_driver(DEFAULT_DRIVER),
-                           help=helps['--driver'])
-    subparser.add_argument('--network', action='append', dest='networks',
-                           metavar='NETWORK', help=helps['--network'])
-    subparser.add_argument('--log-config', type=parse_log_config,
-                           default=default_log_config,
-                           help=helps['--log-config'])
-    subparser.add_argument('--import-module', type=parse_import_module,
-                           action='append', dest='import_modules',
-                           metavar='MODULE', help=helps['--import-module'])
-    subparser.add_argument('file', type=parse_file, help=helps['file'])
-    subparser.set_defaults(action=apply)
+
+    # 引数を構築するのは、指定されたサブコマンドのみ
+    argv = sys.argv[1:2]
+    for subcommand, build in subcommand_builders.items():
+        subparser = subparsers.add_parser(subcommand)
+        if argv == [subcommand]:
+            build(subparser)
 
     args = parser.parse_args()
 
+    # --help や引数エラーの場合は core (とドライバ) を読み込まずに終了する
+    from .core import apply
+
     logging.config.dictConfig(args.log_config)
 
     logger.debug(args)
@@ -154,6 +182,6 @@ def main() -> None:
 
     if isinstance(args.file, URL):
         with open_url(args.file, encoding='utf8') as f:
-            args.action(args.driver, f, networks)
+            apply(args.driver, f, networks)
     else:
-        args.action(args.driver, args.file, networks)
+        apply(args.driver, args.file, networks)
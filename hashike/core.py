@@ -1,5 +1,7 @@
 import logging.config
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import chain
 from typing import IO, Any, Iterable, TypeVar
 
 import yaml
@@ -7,12 +9,19 @@ import yaml
 from .drivers import (Container, Driver, EnvVar, Image,
                       NetworkAlreadyExistsError, Port, Volume,
                       VolumeNotFoundError)
+from .drivers.base import port_sort_key
 from .pullers import get_puller
-from .utils import package_name, parse_image_url
+from .utils import default_network, package_name, parse_image_url
 
 logger = logging.getLogger(package_name)
 
-default_network = package_name
+default_port_protocol: str = Port._field_defaults['protocol']
+
+max_pull_workers = 8
+max_run_workers = 16
+
+# libyaml があれば C 実装のローダーを使用する
+yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 
 @dataclass
@@ -24,7 +33,9 @@ class ApplyResult:
 
 
 def _merge_envs(*envs: Iterable[EnvVar]) -> list[EnvVar]:
-    return [x for x in set(y for x in envs for y in x)]
+    # 同名の環境変数は後に指定されたもので上書きする (イメージ < コンテナ)
+    merged = {x.name: x for x in chain.from_iterable(envs)}
+    return sorted(merged.values())
 
 
 @dataclass
@@ -33,6 +44,11 @@ class _ParseContainer:
     volumes: dict[str, Volume]
     networks: list[str]
     restart_policy: str
+    sorted_networks: tuple[str, ...] = field(init=False)
+
+    def __post_init__(self):
+        # 全コンテナで共通なので、一度だけソートして同じタプルを共有する
+        self.sorted_networks = tuple(sorted(self.networks))
 
     def __call__(self, container: dict[str, Any],
                  init: bool = False) -> Container:
@@ -43,21 +59,18 @@ class _ParseContainer:
 
         ports = []
         for port in container.get('ports', []):
-            port_kwargs = dict(
+            protocol = port.get('protocol') or default_port_protocol
+            ports.append(Port(
                 container_port=port['containerPort'],
                 host_ip=port.get('hostIp'),
-                host_port=port.get('hostPort', port['containerPort'])
-            )
-            protocol = port.get('protocol')
-            if protocol:
-                port_kwargs['protocol'] = protocol
-            ports.append(Port(**port_kwargs))
-        ports = sorted(ports)
+                host_port=port.get('hostPort', port['containerPort']),
+                protocol=protocol
+            ))
+        ports = sorted(ports, key=port_sort_key)
 
         environment = _merge_envs(image.environment,
                                   [EnvVar(env['name'], str(env['value']))
                                    for env in container.get('env', [])])
-        environment = sorted(environment)
 
         if init and self.restart_policy == 'Always':
             # https://kubernetes.io/ja/docs/concepts/workloads/pods/init-containers/#detailed-behavior
@@ -68,8 +81,6 @@ class _ParseContainer:
         # https://kubernetes.io/docs/reference/generated/kubernetes-api/v1.30/#container-v1-core
         restart_policy = container.get('restartPolicy', default_restart_policy)
 
-        networks = sorted(self.networks)
-
         mounts = []
         for mount in container.get('volumeMounts', []):
             volume = self.volumes[mount['name']]
@@ -81,7 +92,7 @@ class _ParseContainer:
                          entrypoint=tuple(command), command=tuple(args),
                          environment=tuple(environment), ports=tuple(ports),
                          restart_policy=restart_policy,
-                         networks=tuple(networks),
+                         networks=self.sorted_networks,
                          mounts=tuple(mounts))
 
 
@@ -89,8 +100,19 @@ T = TypeVar('T')
 
 
 def _diff(a: list[T], b: list[T]) -> list[T]:
-    diff = set(a) - set(b)
-    return [x for x in a if x in diff]
+    b_set = frozenset(b)
+    return [x for x in a if x not in b_set]
+
+
+def _same_containers(a: list[Container], b: list[Container]) -> bool:
+    if len(a) != len(b):
+        return False  # 件数が異なれば、ハッシュを計算するまでもなく不一致
+
+    if not a:
+        return True  # 双方とも空 (初期化コンテナ無し) なら一致
+
+    # ドライバが返すコンテナの順序はマニフェストの順序と一致するとは限らない
+    return frozenset(a) == frozenset(b)
 
 
 def apply(driver: Driver, file: IO[str], networks: list[str]) -> ApplyResult:
@@ -99,23 +121,28 @@ def apply(driver: Driver, file: IO[str], networks: list[str]) -> ApplyResult:
     logger.debug(f'Networks: {networks}')
 
     # マニフェストを読み込み、次の起動コンテナ情報を得る
-    manifest = yaml.safe_load(file)
+    # (ストリームを渡すと libyaml が read() を都度呼び出すため、先に全て読み込む)
+    manifest = yaml.load(file.read(), Loader=yaml_loader)
 
     init_containers = manifest['spec'].get('initContainers', [])
     containers = manifest['spec']['containers']
 
-    # イメージの辞書
-    images: dict[str, Image] = {}
-
-    for container in init_containers + containers:
+    # 同じイメージは一度だけ pull する (順序を保つため dict で重複を除く)
+    image_names: dict[str, None] = {}
+    for container in chain(init_containers, containers):
         logger.debug(f"{container['name']} @ {container['image']}")
-        image_url = parse_image_url(container['image'])
+        image_names[container['image']] = None
 
-        # イメージを pull
-        image = get_puller(image_url.scheme)(image_url, driver)
+    def pull(image_name: str) -> Image:
+        image_url = parse_image_url(image_name)
+        return get_puller(image_url.scheme)(image_url, driver)
 
-        # イメージ名とオブジェクトのペアを保存
-        images[container['image']] = image
+    # イメージの pull は互いに独立しているので並行に行う
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(max_pull_workers, len(image_names)))
+    ) as executor:
+        # イメージ名とオブジェクトの辞書
+        images = dict(zip(image_names, executor.map(pull, image_names)))
 
     if networks:
         networks = networks.copy()
@@ -165,7 +192,7 @@ def apply(driver: Driver, file: IO[str], networks: list[str]) -> ApplyResult:
     logger.debug(f'次回のコンテナ: {next_containers}')
 
     # 削除するコンテナと起動するコンテナを決定
-    if existing_init_containers == next_init_containers:
+    if _same_containers(existing_init_containers, next_init_containers):
         # 初期化コンテナに変更がなければ、定義差分から決定
         unnecessary_containers = _diff(existing_containers, next_containers)
         new_containers = _diff(next_containers, existing_containers)
@@ -193,6 +220,7 @@ def apply(driver: Driver, file: IO[str], networks: list[str]) -> ApplyResult:
         driver.remove_containers(x.name for x in unnecessary_init_containers)
 
     # 新しい初期化コンテナを起動
+    # (失敗した場合に既存のコンテナが動き続けるよう、コンテナの削除より前に行う)
     logger.debug(f'起動する初期化コンテナ: {new_init_containers}')
     for container in new_init_containers:
         driver.run_init_container(container)
@@ -204,8 +232,12 @@ def apply(driver: Driver, file: IO[str], networks: list[str]) -> ApplyResult:
 
     # 新しいコンテナを起動
     logger.debug(f'起動するコンテナ: {new_containers}')
-    for container in new_containers:
-        driver.run_container(container)
+    if new_containers:
+        # 初期化コンテナと異なり順序の制約はないので並行に起動する
+        with ThreadPoolExecutor(
+            max_workers=min(max_run_workers, len(new_containers))
+        ) as executor:
+            list(executor.map(driver.run_container, new_containers))
 
     return ApplyResult(removed_init_containers=unnecessary_init_containers,
                        created_init_containers=new_init_containers,
@@ -1,8 +1,15 @@
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
 from abc import ABC, abstractmethod
-from collections.abc import Iterable
-from dataclasses import dataclass
-from typing import IO, Any, Literal, NamedTuple, Optional, Type, TypeVar, Union
+from collections.abc import Callable, Iterable
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from functools import lru_cache, wraps
+from typing import (IO, Any, Literal, NamedTuple, Optional, Type, TypeVar,
+                    Union, cast)
 
 
 class EnvVar(NamedTuple):
@@ -10,6 +17,18 @@ class EnvVar(NamedTuple):
     value: str
 
 
+# 同じイメージから作成したコンテナは同じ環境変数を持つことが多いため、
+# 分割とソートの結果を使い回す
+@lru_cache(maxsize=1024)
+def parse_environment(env: tuple[str, ...]) -> tuple[EnvVar, ...]:
+    # "NAME=VALUE" 形式の文字列のままソートすると、例えば "A0=" が "A=" より
+    # 前になり、(name, value) の順序と食い違うため、分割してからソートする
+    # EnvVar を作る前の素のタプルのままソートし、生成はソート後に一度だけ行う
+    pairs = [x.partition('=') for x in env]
+    pairs.sort()
+    return tuple([EnvVar(name, value) for name, _, value in pairs])
+
+
 class Image(NamedTuple):
     id: str  # sha256: から始まるイメージ ID
     references: tuple[str, ...] = ()
@@ -26,6 +45,12 @@ class Port(NamedTuple):
     protocol: str = 'tcp'
 
 
+def port_sort_key(port: Port) -> tuple[int, str, int, str]:
+    # host_ip は None の場合があり、そのままでは str と大小比較できない
+    return (port.container_port, port.host_ip or '', port.host_port,
+            port.protocol)
+
+
 class Volume(NamedTuple):
     type: Literal['bind', 'volume']
     source: str
@@ -62,6 +87,16 @@ Self = TypeVar('Self', bound='Driver')
 @dataclass
 class Driver(ABC):
     key: str
+    _cache: dict[str, tuple[float, list[Any]]] = field(
+        default_factory=dict, init=False, repr=False, compare=False
+    )
+    # キャッシュを破棄した回数 (問い合わせ中に破棄された結果を保存しないため)
+    _cache_generation: int = field(
+        default=0, init=False, repr=False, compare=False
+    )
+    _cache_lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False, compare=False
+    )
 
     @abstractmethod
     def get_images(self: Self) -> list[Image]:
@@ -111,6 +146,49 @@ class Driver(ABC):
         return self.key
 
 
+# 問い合わせ結果をキャッシュする秒数 (1 回の apply 内での再利用を想定)
+cache_ttl = 2.0
+
+F = TypeVar('F', bound=Callable[..., Any])
+
+
+def cached_result(method: F) -> F:
+    # 引数を取らない問い合わせメソッドの結果を cache_ttl 秒の間キャッシュする
+    @wraps(method)
+    def wrapper(self: Driver) -> list[Any]:
+        now = time.monotonic()
+        hit = self._cache.get(method.__name__)
+
+        if hit is not None and now - hit[0] < cache_ttl:
+            return list(hit[1])
+
+        generation = self._cache_generation
+        result = method(self)
+
+        with self._cache_lock:
+            # 実行中に変更系のメソッドが完了した場合、結果が古い可能性がある
+            if generation == self._cache_generation:
+                self._cache[method.__name__] = (now, result)
+
+        return list(result)
+
+    return cast(F, wrapper)
+
+
+def invalidates_cache(method: F) -> F:
+    # イメージやコンテナを変更するメソッドの後はキャッシュを破棄する
+    @wraps(method)
+    def wrapper(self: Driver, *args: Any, **kwargs: Any) -> Any:
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            with self._cache_lock:
+                self._cache_generation += 1
+                self._cache.clear()
+
+    return cast(F, wrapper)
+
+
 _map: dict[str, Driver] = {}
 
 
@@ -127,9 +205,73 @@ def driver(key: str):
 
 
 def run_command(
-    command: Union[str, list[str]], shell: bool = True,
+    command: Union[str, list[str]], shell: bool = False,
     capture_output: bool = True, text: bool = True, check: bool = True,
     **kwargs: Any
-) -> subprocess.CompletedProcess[str]:
+) -> subprocess.CompletedProcess[Any]:
     return subprocess.run(command, shell=shell, capture_output=capture_output,
                           text=text, check=check, **kwargs)
+
+
+def run_command_bytes(command: Union[str, list[str]], shell: bool = False,
+                      **kwargs: Any) -> bytes:
+    # 標準出力を str にデコードせず、バイト列のまま返す
+    proc = run_command(command, shell=shell, text=False, **kwargs)
+    return proc.stdout
+
+
+def run_pipeline(*commands: list[str]) -> bytes:
+    # シェルを介さずに、各コマンドの標準出力を次のコマンドの標準入力に繋ぐ
+    procs: list[subprocess.Popen[bytes]] = []
+    stdin = None
+
+    with ExitStack() as stack:
+        # 標準エラー出力は、パイプが詰まらないよう一時ファイルで受け取る
+        stderrs = [stack.enter_context(tempfile.TemporaryFile())
+                   for _ in commands]
+
+        try:
+            for command, stderr in zip(commands, stderrs):
+                proc = subprocess.Popen(command, stdin=stdin,
+                                        stdout=subprocess.PIPE, stderr=stderr)
+                procs.append(proc)
+                if stdin is not None:
+                    stdin.close()  # 前段の出力は後段のみが読む
+                stdin = proc.stdout
+
+            stdout, _ = procs[-1].communicate()
+        except BaseException:
+            # 途中のコマンドが起動できなかった場合も、起動済みのものを残さない
+            for proc in procs:
+                proc.kill()
+            raise
+        finally:
+            for proc in procs:
+                if proc.stdout is not None:
+                    proc.stdout.close()
+                proc.wait()
+
+        for proc, stderr in zip(procs, stderrs):
+            if proc.returncode != 0:
+                stderr.seek(0)
+                raise subprocess.CalledProcessError(
+                    proc.returncode, proc.args, stderr=stderr.read()
+                )
+
+    return stdout
+
+
+def run_command_with_stdin(command: list[str], fileobj: IO[bytes]) -> None:
+    # 入力全体をメモリに読み込まず、チャンク毎に標準入力へ流し込む
+    with subprocess.Popen(command, stdin=subprocess.PIPE,
+                          stdout=subprocess.DEVNULL) as proc:
+        assert proc.stdin is not None
+        try:
+            shutil.copyfileobj(fileobj, proc.stdin)
+        except BrokenPipeError:
+            pass  # 途中で終了した場合は、終了コードで失敗を判定する
+        finally:
+            proc.stdin.close()
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
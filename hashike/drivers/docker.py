@@ -1,65 +1,171 @@
-import json
 import subprocess
 import time
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import IO, Optional
+from typing import IO, Any, Literal, Optional
 
 import docker.client
 import docker.models
 import docker.types
 
-from ..utils import package_name
-from .base import (Container, Driver, EnvVar, Image, InitContainerFailedError,
+from ..utils import json_loads, package_name
+from .base import (Container, Driver, Image, InitContainerFailedError,
                    NetworkAlreadyExistsError, Port, Volume,
-                   VolumeNotFoundError, driver, run_command)
+                   VolumeNotFoundError, cached_result, driver,
+                   invalidates_cache, parse_environment, port_sort_key,
+                   run_command, run_command_bytes, run_command_with_stdin,
+                   run_pipeline)
 
 label_key = package_name
-
-restart_policy_bimap = {
+# 通常のコンテナと init コンテナを区別するラベル (docker の key=value 形式)
+container_label = f'{label_key}='
+init_container_label = f'{label_key}=init'
+# CLI で作成したコンテナの、本来のエントリーポイントの要素数を記録するラベル
+entrypoint_length_label_key = f'{label_key}.entrypoint-length'
+
+# Docker Engine API を並行して呼び出す際の最大スレッド数
+max_api_workers = 16
+# apply は最大 16 個 (core.max_run_workers) のコンテナを並行に起動し、各コンテナは
+# さらに最大 max_api_workers 並行でネットワークに接続するため、その積だけ接続を保持する
+max_pool_size = 16 * max_api_workers
+
+# 再起動ポリシーの K8s 表記から Docker 表記への対応と、その逆
+docker_restart_policies: dict[str, str] = {
     'Always': 'always',
+    'OnFailure': 'on-failure'
+}
+k8s_restart_policies: dict[str, Literal['Always', 'OnFailure']] = {
     'always': 'Always',
-    'OnFailure': 'on-failure',
     'on-failure': 'OnFailure'
 }
 
 
+def _parse_image(detail: dict[str, Any]) -> Image:
+    # inspect の結果からイメージを組み立てる (SDK と CLI で共通)
+    config = detail['Config']
+    environment = parse_environment(tuple(config.get('Env') or ()))
+    entrypoint = tuple(config.get('Entrypoint') or ())
+    command = tuple(config.get('Cmd') or ())
+    return Image(id=detail['Id'],
+                 references=tuple(detail.get('RepoTags') or ()),
+                 environment=environment, entrypoint=entrypoint,
+                 command=command)
+
+
+def _parse_container(detail: dict[str, Any]) -> Container:
+    # docker container inspect の結果 (SDK の attrs も同じ形式) を変換する
+    name = detail['Name'].removeprefix('/')  # 内部的な名前の先頭には / が付く
+    image_id = detail['Image']
+    # 繰り返し参照する階層は、一度だけ取り出しておく
+    config = detail['Config']
+    host_config = detail['HostConfig']
+    entrypoint = tuple(config.get('Entrypoint') or ())
+    command = tuple(config.get('Cmd') or ())
+
+    if entrypoint == ('',):
+        entrypoint = ()  # --entrypoint '' で空にしたもの
+
+    # --entrypoint は 1 要素しか受け付けないため、CLI では残りの要素を引数の
+    # 先頭に回しているので、記録した要素数に従って元に戻す
+    labels = config.get('Labels') or {}
+    if entrypoint_length_label_key in labels:
+        n = int(labels[entrypoint_length_label_key]) - len(entrypoint)
+        if n > 0:
+            entrypoint += command[:n]
+            command = command[n:]
+
+    port_bindings = host_config.get('PortBindings') or {}
+    ports = sorted((
+        Port(container_port=int(port_s),
+             host_ip=host_binding.get('HostIp') or None,
+             host_port=int(host_binding['HostPort']),
+             protocol=protocol)
+        for container_port_protocol, host_bindings in port_bindings.items()
+        for port_s, protocol in [container_port_protocol.split('/', 1)]
+        for host_binding in host_bindings or ()
+    ), key=port_sort_key)
+
+    environment = parse_environment(tuple(config.get('Env') or ()))
+
+    policy = host_config.get('RestartPolicy')
+    restart_policy = k8s_restart_policies[
+        policy.get('Name', 'always') if policy else 'always'
+    ]
+
+    # dict をそのままソートするとキー (ネットワーク名) が並ぶ
+    networks = tuple(sorted(detail['NetworkSettings'].get('Networks') or ()))
+
+    mounts = tuple(sorted(
+        Volume(type=x['Type'], source=x.get('Name', x['Source']),
+               target=x['Destination'])
+        for x in detail['Mounts']
+    ))
+
+    return Container(name=name, image_id=image_id,
+                     entrypoint=entrypoint, command=command,
+                     environment=environment, ports=tuple(ports),
+                     restart_policy=restart_policy, networks=networks,
+                     mounts=mounts)
+
+
 @driver('docker')
 @dataclass
 class DockerDriver(Driver):
     client: docker.client.DockerClient = field(init=False)
+    _networks: dict[str, docker.models.networks.Network] = field(
+        default_factory=dict, init=False, repr=False
+    )
 
     def __post_init__(self):
-        self.client = docker.from_env()
-
-    def _create_image(self, image: docker.models.images.Image):
-        environment = tuple(sorted(
-            EnvVar(*env.split('=', 1))
-            for env in image.attrs['Config'].get('Env') or []
-        ))
-        entrypoint = tuple(image.attrs['Config'].get('Entrypoint') or [])
-        command = tuple(image.attrs['Config'].get('Cmd') or [])
-        return Image(id=image.id, references=tuple(image.attrs['RepoTags']),
-                     environment=environment, entrypoint=entrypoint,
-                     command=command)
+        # 並行実行するスレッド数より接続プールが小さいと、接続が破棄される
+        self.client = docker.from_env(max_pool_size=max_pool_size)
 
+    def _get_network(
+        self, network: str
+    ) -> Optional[docker.models.networks.Network]:
+        if network not in self._networks:
+            # 未知のネットワークであれば、一覧を取得し直す
+            self._networks = {x.name: x for x in self.client.networks.list()}
+
+        return self._networks.get(network)
+
+    @cached_result
     def get_images(self) -> list[Image]:
-        return list(map(self._create_image, self.client.images.list()))
+        # images.list() はイメージ毎に逐次 inspect するため、
+        # 低レベル API で一覧を取得し、詳細は並行して取得する
+        ids = [x['Id'] for x in self.client.api.images()]
+
+        if not ids:
+            return []
 
+        with ThreadPoolExecutor(
+            max_workers=min(max_api_workers, len(ids))
+        ) as executor:
+            details = executor.map(self.client.api.inspect_image, ids)
+            return list(map(_parse_image, details))
+
+    @invalidates_cache
     def pull(self, image: str) -> Image:
         repo, tag = image.split(':', 1)
-        self.client.images.pull(repo, tag)
-        return self._create_image(self.client.images.get(image))
+        # タグを指定した pull は取得済みのイメージを返すので、再取得は不要
+        return _parse_image(self.client.images.pull(repo, tag).attrs)
 
+    @invalidates_cache
     def load_docker_archive(self, fileobj: IO[bytes]) -> None:
-        self.client.images.load(fileobj.read())
+        # ファイルオブジェクトをそのまま渡し、全体を読み込まずに送信する
+        self.client.images.load(fileobj)
 
     def create_network(self, network: str) -> None:
-        if self.client.networks.list(network):
+        # 一覧ではなく、単一のネットワークを取得して存在を確認する
+        try:
+            self.client.networks.get(network)
+        except docker.errors.NotFound:
+            self.client.networks.create(network, driver='bridge')
+            self._networks.clear()
+        else:
             raise NetworkAlreadyExistsError(network)
 
-        self.client.networks.create(network, driver='bridge')
-
     def get_volume(self, volume: str) -> Volume:
         try:
             v = self.client.volumes.get(volume)
@@ -72,75 +178,53 @@ class DockerDriver(Driver):
         v = self.client.volumes.create(volume, labels={label_key: None})
         return Volume(type='volume', source=v.name)
 
-    def _get_containers(self, init: bool = False) -> list[Container]:
-        label = f"{label_key}={'init' if init else ''}"
-        containers = self.client.containers.list(all=True,
-                                                 filters=dict(label=label))
-
-        results = []
-
-        for container in containers:
-            entrypoint = container.attrs['Config'].get('Entrypoint') or []
-            command = container.attrs['Config'].get('Cmd') or []
-
-            ports = []
-            port_bindings = \
-                container.attrs['HostConfig'].get('PortBindings') or {}
-            for (container_port_protocol,
-                 host_bindings) in port_bindings.items():
-                port_s, protocol = container_port_protocol.split('/', 1)
-                container_port = int(port_s)
-                for host_binding in host_bindings or {}:
-                    ports.append(Port(
-                        container_port=container_port,
-                        host_ip=host_binding.get('HostIp') or None,
-                        host_port=int(host_binding['HostPort']),
-                        protocol=protocol
-                    ))
-            ports = sorted(ports)
-
-            environment = tuple(sorted(
-                EnvVar(*x.split('=', 1))
-                for x in container.attrs['Config'].get('Env') or []
-            ))
+    def _inspect_container(self, id: str) -> Optional[dict[str, Any]]:
+        try:
+            return self.client.api.inspect_container(id)
+        except docker.errors.NotFound:
+            return None  # 一覧の取得後に削除された
 
-            restart_policy = (
-                container.attrs['HostConfig'].get('RestartPolicy') or {}
-            ).get('Name', 'always')
-            restart_policy = restart_policy_bimap[restart_policy]
+    def _get_containers(self, init: bool = False) -> list[Container]:
+        label = init_container_label if init else container_label
 
-            networks = tuple(sorted((
-                container.attrs['NetworkSettings'].get('Networks') or {}
-            ).keys()))
+        # containers.list() はコンテナ毎に逐次 inspect するため、
+        # 低レベル API で一覧を取得し、詳細は並行して取得する
+        ids = [x['Id'] for x in self.client.api.containers(
+            all=True, filters=dict(label=label)
+        )]
 
-            mounts = tuple(sorted(
-                Volume(type=x['Type'], source=x.get('Name', x['Source']),
-                       target=x['Destination'])
-                for x in container.attrs['Mounts']
-            ))
-
-            results.append(Container(name=container.name,
-                                     image_id=container.image.id,
-                                     entrypoint=tuple(entrypoint),
-                                     command=tuple(command),
-                                     environment=environment,
-                                     ports=tuple(ports),
-                                     restart_policy=restart_policy,
-                                     networks=networks,
-                                     mounts=mounts))
+        if not ids:
+            return []
 
-        return results
+        with ThreadPoolExecutor(
+            max_workers=min(max_api_workers, len(ids))
+        ) as executor:
+            details = executor.map(self._inspect_container, ids)
+            return [_parse_container(x) for x in details if x]
 
+    @cached_result
     def get_init_containers(self) -> list[Container]:
         return self._get_containers(init=True)
 
+    @cached_result
     def get_containers(self) -> list[Container]:
         return self._get_containers()
 
+    @invalidates_cache
     def remove_containers(self, names: Iterable[str]) -> None:
-        for name in names:
-            container = self.client.containers.get(name)
-            container.remove(force=True)
+        targets = list(names)
+
+        if not targets:
+            return
+
+        # 事前の取得は不要なので、名前を指定して直接削除し、並行に行う
+        with ThreadPoolExecutor(
+            max_workers=min(max_api_workers, len(targets))
+        ) as executor:
+            list(executor.map(
+                lambda x: self.client.api.remove_container(x, force=True),
+                targets
+            ))
 
     def _run_container(
         self, container: Container, init: bool = False
@@ -151,7 +235,7 @@ class DockerDriver(Driver):
             run_opts['network'] = container.networks[0]
 
         restart_policy = dict(
-            Name=restart_policy_bimap[container.restart_policy]
+            Name=docker_restart_policies[container.restart_policy]
         )
 
         mounts = [
@@ -174,13 +258,20 @@ class DockerDriver(Driver):
             **run_opts
         )
 
-        if container.networks[1:]:
-            networks = self.client.networks.list(names=container.networks[1:])
-            for network in networks:
-                network.connect(raw_container)
+        networks = [x for x in map(self._get_network,
+                                   container.networks[1:]) if x]
+
+        # 2 つ目以降のネットワークへの接続は互いに独立なので、並行に行う
+        if networks:
+            with ThreadPoolExecutor(
+                max_workers=min(max_api_workers, len(networks))
+            ) as executor:
+                list(executor.map(lambda x: x.connect(raw_container),
+                                  networks))
 
         return raw_container
 
+    @invalidates_cache
     def run_init_container(self, container: Container) -> None:
         raw_container = self._run_container(container, init=True)
 
@@ -202,6 +293,7 @@ class DockerDriver(Driver):
             if response['StatusCode'] != 0:
                 raise InitContainerFailedError
 
+    @invalidates_cache
     def run_container(self, container: Container) -> None:
         self._run_container(container)
 
@@ -209,185 +301,141 @@ class DockerDriver(Driver):
 @driver('docker-cli')
 @dataclass
 class DockerCLIDriver(Driver):
-    def _get_images(self, id_or_ref: Optional[str] = None):
-        cmd = 'docker image ls --no-trunc --format "{{.ID}}"'
-
-        if id_or_ref:
-            cmd += ' ' + id_or_ref
-
-        ids = set(run_command(cmd).stdout.strip().splitlines())
-
-        proc = run_command(f"docker image inspect {' '.join(ids)}")
-        details = json.loads(proc.stdout)
-
-        for detail in details:
-            id = detail['Id']
-            refs = tuple(detail['RepoTags'])
-            environment = tuple(sorted(
-                EnvVar(*env.split('=', 1))
-                for env in detail['Config'].get('Env') or []
-            ))
-            entrypoint = tuple(detail['Config'].get('Entrypoint') or [])
-            command = tuple(detail['Config'].get('Cmd') or [])
-            yield Image(id=id, references=refs, environment=environment,
-                        entrypoint=entrypoint, command=command)
-
+    @cached_result
     def get_images(self) -> list[Image]:
-        return list(self._get_images())
+        cmd = ['docker', 'image', 'ls', '--no-trunc', '--format', '{{.ID}}']
+
+        # 一覧と詳細の取得を 1 回のパイプラインで行う
+        # xargs が inspect を複数回に分けて実行しても連結できるよう、
+        # 詳細は 1 行に 1 イメージの JSON で出力し、行毎にパースする
+        stdout = run_pipeline(
+            cmd, ['xargs', '-r', 'docker', 'image', 'inspect',
+                  '--format', '{{json .}}']
+        )
+
+        # 複数のタグを持つイメージは一覧に重複して現れる
+        lines = (x for x in stdout.splitlines() if x.strip())
+        details = {x['Id']: x for x in map(json_loads, lines)}.values()
+        return list(map(_parse_image, details))
 
+    @invalidates_cache
     def pull(self, image: str) -> Image:
-        run_command(f'docker image pull {image}')
-        return next(self._get_images(image))
+        run_command(['docker', 'image', 'pull', '--quiet', image])
+        # 一覧を介さず、取得したイメージを直接 inspect する
+        stdout = run_command_bytes(['docker', 'image', 'inspect', image])
+        return _parse_image(json_loads(stdout)[0])
 
+    @invalidates_cache
     def load_docker_archive(self, fileobj: IO[bytes]) -> None:
-        run_command('docker image load', input=fileobj.read())
+        run_command_with_stdin(['docker', 'image', 'load'], fileobj)
 
     def create_network(self, network: str) -> None:
         try:
-            run_command('docker network create --driver bridge ' + network)
+            run_command(['docker', 'network', 'create', '--driver', 'bridge',
+                         network])
         except subprocess.CalledProcessError as e:
             raise NetworkAlreadyExistsError from e  # ネットワーク重複エラーとみなす
 
     def get_volume(self, volume: str) -> Volume:
         try:
-            proc = run_command('docker volume inspect ' + volume)
+            stdout = run_command_bytes(['docker', 'volume', 'inspect',
+                                        volume])
         except subprocess.CalledProcessError as e:
             raise VolumeNotFoundError from e  # 見つからないエラーとみなす
 
-        return Volume(type='volume', source=json.loads(proc.stdout)[0]['Name'])
+        return Volume(type='volume', source=json_loads(stdout)[0]['Name'])
 
     def create_volume(self, volume: str) -> Volume:
-        run_command(f'docker volume create --label={label_key} {volume}')
-        return self.get_volume(volume)
+        # create は作成したボリューム名を出力するので、再度の inspect は不要
+        proc = run_command(['docker', 'volume', 'create',
+                            f'--label={label_key}', volume])
+        return Volume(type='volume', source=proc.stdout.strip())
 
     def _get_containers(self, init: bool = False) -> list[Container]:
-        label = f"{label_key}={'init' if init else ''}"
-        cmd = ('docker container ls --all --no-trunc '
-               f'--filter "label={label}" '
-               '--format "{{.ID}}"')
-
-        ids = [x
-               for x in run_command(cmd).stdout.strip().splitlines()
-               if x.strip()]
-
-        if not ids:
-            return []
-
-        proc = run_command('docker container inspect ' + ' '.join(ids))
-        details = json.loads(proc.stdout)
-
-        results = []
-
-        for detail in details:
-            name = detail['Name'].removeprefix('/')  # 内部的な名前の先頭には / が付く
-            image_id = detail['Image']
-            entrypoint = detail['Config'].get('Entrypoint') or []
-            command = detail['Config'].get('Cmd') or []
-
-            ports = []
-            port_bindings = detail['HostConfig'].get('PortBindings') or {}
-            for (container_port_protocol,
-                 host_bindings) in port_bindings.items():
-                port_s, protocol = container_port_protocol.split('/', 1)
-                container_port = int(port_s)
-                for host_binding in host_bindings or {}:
-                    ports.append(Port(
-                        container_port=container_port,
-                        host_ip=host_binding.get('HostIp') or None,
-                        host_port=int(host_binding['HostPort']),
-                        protocol=protocol
-                    ))
-            ports = sorted(ports)
-
-            environment = tuple(sorted(
-                EnvVar(*env.split('=', 1))
-                for env in detail['Config'].get('Env') or []
-            ))
-
-            restart_policy = (
-                detail['HostConfig'].get('RestartPolicy') or {}
-            ).get('Name', 'always')
-            restart_policy = restart_policy_bimap[restart_policy]
-
-            networks = tuple(sorted(
-                (detail['NetworkSettings'].get('Networks') or {}).keys()
-            ))
-
-            mounts = tuple(sorted(
-                Volume(type=x['Type'], source=x.get('Name', x['Source']),
-                       target=x['Destination'])
-                for x in detail['Mounts']
-            ))
-
-            results.append(Container(name=name, image_id=image_id,
-                                     entrypoint=tuple(entrypoint),
-                                     command=tuple(command),
-                                     environment=environment,
-                                     ports=tuple(ports),
-                                     restart_policy=restart_policy,
-                                     networks=networks,
-                                     mounts=mounts))
+        label = init_container_label if init else container_label
+        cmd = ['docker', 'container', 'ls', '--all', '--no-trunc',
+               '--filter', f'label={label}', '--format', '{{.ID}}']
+
+        # 一覧と詳細の取得を 1 回のパイプラインで行う
+        # 詳細は 1 行に 1 コンテナの JSON で出力し、行毎にパースする
+        stdout = run_pipeline(
+            cmd, ['xargs', '-r', 'docker', 'container', 'inspect',
+                  '--format', '{{json .}}']
+        )
 
-        return results
+        return [_parse_container(json_loads(x)) for x in stdout.splitlines()
+                if x.strip()]
 
+    @cached_result
     def get_init_containers(self) -> list[Container]:
         return self._get_containers(init=True)
 
+    @cached_result
     def get_containers(self) -> list[Container]:
         return self._get_containers()
 
+    @invalidates_cache
     def remove_containers(self, names: Iterable[str]) -> None:
-        run_command(f"docker container rm -f {' '.join(names)}")
+        run_command(['docker', 'container', 'rm', '-f', *names])
 
     def _run_container(self, container: Container, init: bool = False) -> None:
-        env_opts = (f'--env {k}={v}' for k, v in container.environment)
-        entrypoint = (f'"{x}"' if ' ' in x else x
-                      for x in container.entrypoint)
-        command = (f'"{x}"' if ' ' in x else x for x in container.command)
-        publish_opts = (
-            f'--publish {x.host_port}:{x.container_port}/{x.protocol}'
-            for x in container.ports
-        )
-        restart_policy = restart_policy_bimap[container.restart_policy]
+        # シェルを介さないので、引数のクォートは不要
+        cmd = ['docker', 'container', 'run',
+               '--name', container.name,
+               '--label', init_container_label if init else container_label,
+               '--restart', docker_restart_policies[container.restart_policy],
+               '--detach']
 
-        network_opt = ''
         if container.networks:
-            network_opt = '--network ' + container.networks[0]
+            cmd += ['--network', container.networks[0]]
 
-        mount_ops = (
-            f'--mount type={x.type},source="{x.source}",target={x.target}'
-            for x in container.mounts
-        )
+        for name, value in container.environment:
+            cmd += ['--env', f'{name}={value}']
+
+        for port in container.ports:
+            publish = f'{port.host_port}:{port.container_port}/{port.protocol}'
+            if port.host_ip:
+                publish = f'{port.host_ip}:{publish}'
+            cmd += ['--publish', publish]
 
-        run_command(f"""
-docker container run
-    --name {container.name}
-    --label {f"{label_key}={'init' if init else ''}"}
-    --restart {restart_policy}
-    {network_opt}
-    --detach
-    {' '.join(env_opts)}
-    --entrypoint {' '.join(entrypoint)}
-    {' '.join(publish_opts)}
-    {' '.join(mount_ops)}
-    {container.image_id}
-    {' '.join(command)}
-""".replace('\n', ' ').strip())
-
-        for network in container.networks[1:]:
-            run_command(f'docker network connect {network} {container.name}')
+        for mount in container.mounts:
+            cmd += ['--mount', (f'type={mount.type},source={mount.source},'
+                                f'target={mount.target}')]
 
+        # --entrypoint は 1 要素しか受け付けないため、残りは引数の先頭に回し、
+        # 本来の要素数をラベルに記録しておく (空の場合はイメージの設定を消す)
+        entrypoint, *entrypoint_args = container.entrypoint or ('',)
+        cmd += ['--entrypoint', entrypoint,
+                '--label', (f'{entrypoint_length_label_key}='
+                            f'{len(container.entrypoint)}')]
+
+        cmd += [container.image_id, *entrypoint_args, *container.command]
+
+        run_command(cmd)
+
+        networks = container.networks[1:]
+
+        if networks:
+            with ThreadPoolExecutor(
+                max_workers=min(max_api_workers, len(networks))
+            ) as executor:
+                list(executor.map(
+                    lambda x: run_command(['docker', 'network', 'connect',
+                                           x, container.name]),
+                    networks
+                ))
+
+    @invalidates_cache
     def run_init_container(self, container: Container) -> None:
-        self._run_container(container)
+        self._run_container(container, init=True)
 
         if container.restart_policy == 'Always':
             ready = False
             n_healthy = 0
-            cmd = ('docker container inspect --format "{{json .State}}" '
-                   f'{container.name}')
+            cmd = ['docker', 'container', 'inspect', '--format',
+                   '{{json .State}}', container.name]
             for _ in range(60):
-                proc = run_command(cmd)
-                details = json.loads(proc.stdout)
+                details = json_loads(run_command_bytes(cmd))
                 if details['Status'] == 'running':
                     n_healthy += 1
                     if n_healthy == 4:
@@ -397,10 +445,11 @@ docker container run
             if not ready:
                 raise InitContainerFailedError
         else:
-            cmd = 'docker container wait ' + container.name
+            cmd = ['docker', 'container', 'wait', container.name]
             proc = run_command(cmd)  # 終了を待機
             if int(proc.stdout) != 0:
                 raise InitContainerFailedError
 
+    @invalidates_cache
     def run_container(self, container: Container) -> None:
         self._run_container(container)
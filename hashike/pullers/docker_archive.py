@@ -1,59 +1,126 @@
 import json
 import tarfile
+import threading
 from functools import cache
 from pathlib import Path
+from typing import Any
 
 from ..drivers import Driver, EnvVar, Image
-from ..utils import URL, open_url, tmp_dir
+from ..drivers.base import parse_environment
+from ..utils import (URL, get_s3_client, get_s3_transfer_config, json_loads,
+                     tmp_dir)
 from .base import puller
 
+# 同じアーカイブを並行してダウンロード、ロードしないよう直列化する
+_lock = threading.Lock()
+
 
 @cache
 def download_docker_archive_from_s3(url: URL) -> Path:
-    if not url.path:
+    if not (url.hostname and url.path):
         raise ValueError
 
     download_path = tmp_dir / url.path.name
-
-    with open_url(url, 'rb') as remote:
-        with download_path.open('wb') as f:
-            f.write(remote.read())
+    etag_path = download_path.with_name(f'{download_path.name}.etag')
+    key = str(url.path.relative_to('/'))
+    client = get_s3_client()
+
+    # 前回のプロセスでダウンロードしたアーカイブが S3 上のオブジェクトと
+    # 同じ (ETag が一致する) 場合は、ダウンロードせずにそのまま使う
+    head = client.head_object(Bucket=url.hostname, Key=key)
+    etag = head['ETag']
+
+    try:
+        if download_path.exists() and etag_path.read_text() == etag:
+            return download_path
+    except OSError:
+        pass  # ETag が保存されていない
+
+    etag_path.unlink(missing_ok=True)  # ダウンロード中は一致させない
+
+    # バージョニングが有効なら、確認したバージョンそのものをダウンロードする
+    version_id = head.get('VersionId')
+    extra_args = {'VersionId': version_id} if version_id else {}
+    client.download_file(url.hostname, key, str(download_path),
+                         ExtraArgs=extra_args,
+                         Config=get_s3_transfer_config())
+
+    # 確認後にオブジェクトが更新された場合は、ETag と内容が食い違うので失敗させる
+    if not extra_args:
+        head = client.head_object(Bucket=url.hostname, Key=key)
+        if head['ETag'] != etag:
+            download_path.unlink(missing_ok=True)
+            raise ValueError(f'{url} was modified during download')
+
+    etag_path.write_text(etag)
 
     return download_path
 
 
-@cache
-def get_images_from_docker_archive(download_path: Path) -> list[Image]:
+def _read_images_from_docker_archive(download_path: Path) -> list[Image]:
     r: list[Image] = []
+    blobs: dict[str, Any] = {}
 
+    # 圧縮されたアーカイブでは、名前による取り出しの度に先頭から展開し直すため、
+    # メンバーを先頭から一度だけ走査し、必要な JSON をまとめて読み込む
+    # (ストリームモードではレイヤーも読み飛ばせないため、シーク可能なモードで開く)
     with tarfile.open(download_path) as f:
-        buff = f.extractfile('manifest.json')
+        for member in f:
+            if member.isfile() and member.name.endswith('.json'):
+                buff = f.extractfile(member)
+                if buff:
+                    blobs[member.name] = json_loads(buff.read())
 
-        if not buff:
-            raise ValueError('manifest.json was not found')
+    if 'manifest.json' not in blobs:
+        raise ValueError('manifest.json was not found')
 
-        manifest = json.load(buff)
+    for item in blobs['manifest.json']:
+        image_id = 'sha256:' + item['Config'].removesuffix('.json')
+        refs = item['RepoTags']
 
-        for item in manifest:
-            image_id = 'sha256:' + item['Config'].removesuffix('.json')
-            refs = item['RepoTags']
+        if item['Config'] not in blobs:
+            raise ValueError(f"{item['Config']} was not found")
 
-            buff = f.extractfile(item['Config'])
+        details = blobs[item['Config']]
+        environment = parse_environment(
+            tuple(details['config'].get('Env') or ())
+        )
+        entrypoint = tuple(details['config'].get('Entrypoint') or ())
+        command = tuple(details['config'].get('Cmd') or ())
 
-            if not buff:
-                raise ValueError(f"{item['Config']} was not found")
+        r.append(Image(id=image_id, references=tuple(refs),
+                       environment=environment, entrypoint=entrypoint,
+                       command=command))
 
-            details = json.load(buff)
-            environment = tuple(sorted(
-                EnvVar(*env.split('=', 1))
-                for env in details['config'].get('Env') or []
-            ))
-            entrypoint = tuple(details['config'].get('Entrypoint') or [])
-            command = tuple(details['config'].get('Cmd') or [])
+    return r
 
-            r.append(Image(id=image_id, references=tuple(refs),
-                           environment=environment, entrypoint=entrypoint,
-                           command=command))
+
+@cache
+def get_images_from_docker_archive(download_path: Path) -> list[Image]:
+    # 解析結果をアーカイブの隣に保存し、次回以降のプロセスでも再利用する
+    # (実行可能なデータを一時ディレクトリから読み込まないよう、JSON で保存する)
+    stat = download_path.stat()
+    key = [stat.st_mtime_ns, stat.st_size]
+    cache_path = download_path.with_name(f'{download_path.name}.images.json')
+
+    try:
+        cached = json_loads(cache_path.read_bytes())
+        if cached['key'] == key:
+            return [Image(id=id, references=tuple(refs),
+                          environment=tuple(EnvVar(*x) for x in env),
+                          entrypoint=tuple(entrypoint),
+                          command=tuple(command))
+                    for id, refs, env, entrypoint, command
+                    in cached['images']]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass  # キャッシュが無いか壊れている場合は、アーカイブから読み込む
+
+    r = _read_images_from_docker_archive(download_path)
+
+    try:
+        cache_path.write_text(json.dumps({'key': key, 'images': r}))
+    except OSError:
+        pass  # キャッシュは保存できなくても動作に影響しない
 
     return r
 
@@ -67,21 +134,23 @@ def pull_from_docker_archive_on_s3(url: URL, driver: Driver) -> Image:
     src_url_path = url.path.parent
     src_ref = url.path.name
     src_url = url.replace(scheme=src_url_scheme, path=src_url_path)
-    download_path = download_docker_archive_from_s3(src_url)
-    archive_images = get_images_from_docker_archive(download_path)
 
-    target_image = None
-    loaded = False
-    existing_images = driver.get_images()
+    with _lock:
+        download_path = download_docker_archive_from_s3(src_url)
+        archive_images = get_images_from_docker_archive(download_path)
 
-    for image in archive_images:  # アーカイブに含まれる全てのイメージ
-        if src_ref in image.references:
-            target_image = image
+        # イメージ毎にリストを線形探索しないよう、集合にしておく
+        existing_images = set(driver.get_images())
 
-        if not loaded and image not in existing_images:  # 既存のイメージリストに存在しない場合
+        # アーカイブに含まれるイメージが 1 つでも既存のイメージリストに
+        # 存在しない場合は、アーカイブをロード
+        if any(x not in existing_images for x in archive_images):
             with download_path.open('rb') as f:
-                driver.load_docker_archive(f)  # アーカイブをロード
-                loaded = True
+                driver.load_docker_archive(f)
+
+    # 参照 (リポジトリ:タグ) からイメージを引けるようにしておく
+    by_ref = {ref: x for x in archive_images for ref in x.references}
+    target_image = by_ref.get(src_ref)
 
     if not target_image:
         raise ValueError('target image was not found')
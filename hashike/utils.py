@@ -1,17 +1,26 @@
-import importlib
 import io
 import locale
 import os
-from dataclasses import dataclass, replace
+from functools import lru_cache
 from pathlib import Path, PurePath, PurePosixPath
-from typing import (IO, Literal, Optional, Type, TypeVar, Union, get_args,
-                    overload)
+from typing import (IO, TYPE_CHECKING, Literal, Optional, Type, TypeVar, Union,
+                    cast, get_args, overload)
 from urllib.parse import parse_qs, unquote, urlencode, urlparse, urlunparse
 
-import boto3
+if TYPE_CHECKING:
+    from boto3.s3.transfer import TransferConfig
+    from mypy_boto3_s3 import S3Client
+
+try:
+    # 入手可能なら高速な orjson を使う (bytes をデコードせずに受け付ける)
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads  # type: ignore  # noqa: F401
 
 package_name = Path(__file__).parent.name
 
+default_network = package_name
+
 tmp_dir = Path(
     os.environ.get('temp',
                    os.environ.get('tmp',
@@ -46,15 +55,38 @@ def unparse_qs(queries: dict[str, list[str]]) -> str:
 Self = TypeVar('Self', bound='URL')
 
 
-@dataclass(frozen=True)
 class URL:
+    # 生成の多い不変オブジェクトなので、dataclass(frozen=True) の代わりに
+    # __slots__ を使い、ハッシュ値は初回の計算結果を保持する
+    __slots__ = ('scheme', 'username', 'password', 'hostname', 'port',
+                 'path', 'query', '_hash')
+
+    _fields = ('scheme', 'username', 'password', 'hostname', 'port', 'path',
+               'query')
+
     scheme: Optional[str]
-    username: Optional[str] = None
-    password: Optional[str] = None
-    hostname: Optional[str] = None
-    port: Optional[int] = None
-    path: Optional[PurePosixPath] = None
-    query: Optional[str] = None
+    username: Optional[str]
+    password: Optional[str]
+    hostname: Optional[str]
+    port: Optional[int]
+    path: Optional[PurePosixPath]
+    query: Optional[str]
+    _hash: Optional[int]
+
+    def __init__(self, scheme: Optional[str], username: Optional[str] = None,
+                 password: Optional[str] = None,
+                 hostname: Optional[str] = None, port: Optional[int] = None,
+                 path: Optional[PurePosixPath] = None,
+                 query: Optional[str] = None) -> None:
+        set_field = object.__setattr__
+        set_field(self, 'scheme', scheme)
+        set_field(self, 'username', username)
+        set_field(self, 'password', password)
+        set_field(self, 'hostname', hostname)
+        set_field(self, 'port', port)
+        set_field(self, 'path', path)
+        set_field(self, 'query', query)
+        set_field(self, '_hash', None)
 
     @classmethod
     def create(cls: Type[Self],
@@ -69,20 +101,7 @@ class URL:
             raise TypeError('url_or_path cannot be of type '
                             f'{type(url_or_path)}')
 
-        url = urlparse(url_str)
-
-        def unq(s):
-            if s is None:
-                return None
-            return unquote(s)
-
-        username, password = map(unq, (url.username, url.password,))
-        path = unq(url.path)
-
-        return cls(url.scheme or None, username or None, password or None,
-                   url.hostname or None, url.port or None,
-                   PurePosixPath(path) if path else None,
-                   url.query or None)
+        return cls(*_parse_url(url_str))
 
     @property
     def host(self: Self):
@@ -98,7 +117,20 @@ class URL:
         return parse_qs(self.query)
 
     def replace(self: Self, /, **changes):
-        return replace(self, **changes)
+        unknown = changes.keys() - set(self._fields)
+
+        if unknown:
+            raise TypeError(f'unexpected fields: {", ".join(sorted(unknown))}')
+
+        # __init__ を経由せず、フィールドを直接設定する
+        new = object.__new__(type(self))
+
+        for name in self._fields:
+            value = changes.get(name, getattr(self, name))
+            object.__setattr__(new, name, value)
+
+        object.__setattr__(new, '_hash', None)
+        return new
 
     def copy(self: Self):
         return self.replace()
@@ -108,11 +140,60 @@ class URL:
                            self.host,
                            str(self.path) if self.path else '',
                            '',
-                           unparse_qs(self.queries) if self.queries else '',
+                           self.query or '',  # エンコード済みのまま使う
                            ''))
 
+    def _astuple(self: Self) -> tuple:
+        return tuple(getattr(self, x) for x in self._fields)
+
+    def __eq__(self: Self, other: object) -> bool:
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return self._astuple() == cast(URL, other)._astuple()
+
+    def __hash__(self: Self) -> int:
+        if self._hash is None:
+            object.__setattr__(self, '_hash', hash(self._astuple()))
+        return cast(int, self._hash)
+
+    def __setattr__(self: Self, name: str, value: object) -> None:
+        raise AttributeError(f"cannot assign to field '{name}'")
+
+    def __delattr__(self: Self, name: str) -> None:
+        raise AttributeError(f"cannot delete field '{name}'")
+
+    def __reduce__(self: Self):
+        return (self.__class__, self._astuple())  # copy や pickle 用
+
+    def __repr__(self: Self) -> str:
+        fields = ', '.join(f'{x}={getattr(self, x)!r}' for x in self._fields)
+        return f'{self.__class__.__qualname__}({fields})'
 
-def parse_image_url(url: str):
+
+# 同じ文字列を何度も解析しないよう、URL の各フィールドの値を使い回す
+@lru_cache(maxsize=1024)
+def _parse_url(url_str: str) -> tuple[
+    Optional[str], Optional[str], Optional[str], Optional[str],
+    Optional[int], Optional[PurePosixPath], Optional[str]
+]:
+    url = urlparse(url_str)
+
+    def unq(s):
+        if s is None:
+            return None
+        return unquote(s)
+
+    username, password = map(unq, (url.username, url.password,))
+    path = unq(url.path)
+
+    return (url.scheme or None, username or None, password or None,
+            url.hostname or None, url.port or None,
+            PurePosixPath(path) if path else None,
+            url.query or None)
+
+
+@lru_cache(maxsize=1024)
+def parse_image_url(url: str) -> URL:
     parsed = urlparse(url)
 
     if parsed.scheme and parsed.hostname:
@@ -134,6 +215,40 @@ def parse_image_url(url: str):
     return URL.create('///' + url)
 
 
+max_s3_connections = 16
+# 大きなオブジェクトは、この大きさの範囲に分割して並行にダウンロードする
+s3_multipart_chunk_size = 8 * 1024 * 1024
+
+
+@lru_cache(maxsize=8)
+def _get_s3_client(aws_environ: tuple[tuple[str, str], ...]) -> 'S3Client':
+    # boto3 は読み込みに時間がかかるため、S3 を使う場合にのみ読み込む
+    import boto3
+    from botocore.config import Config
+
+    session = boto3.session.Session()
+    return session.client(
+        's3', config=Config(max_pool_connections=max_s3_connections)
+    )
+
+
+def get_s3_client() -> 'S3Client':
+    # クライアント (と接続プール) は使い回すが、AWS_* 環境変数が変更された
+    # 場合は、その内容を反映した別のクライアントを作成する
+    aws_environ = tuple(sorted((k, v) for k, v in os.environ.items()
+                               if k.startswith('AWS_')))
+    return _get_s3_client(aws_environ)
+
+
+@lru_cache(maxsize=1)
+def get_s3_transfer_config() -> 'TransferConfig':
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(multipart_threshold=s3_multipart_chunk_size,
+                          multipart_chunksize=s3_multipart_chunk_size,
+                          max_concurrency=max_s3_connections)
+
+
 OpenTextMode = Literal['r']
 OpenBinaryMode = Literal['br', 'rb']
 
@@ -157,19 +272,14 @@ def open_s3_url(url, mode='r', encoding=None):
     if not url.hostname:
         raise ValueError('URL hostname is required')
 
-    importlib.reload(boto3)  # for when environ vars are changed
-
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(url.hostname)
     key = str(url.path.relative_to('/'))
-    buffer = io.BytesIO()
-    bucket.download_fileobj(key, buffer)
-    buffer.seek(0)
+    # 全体をメモリに読み込まず、レスポンスボディをそのままストリームとして返す
+    body = get_s3_client().get_object(Bucket=url.hostname, Key=key)['Body']
 
     if mode in get_args(OpenTextMode):
-        return io.TextIOWrapper(buffer, encoding=encoding)
+        return io.TextIOWrapper(body, encoding=encoding)
 
-    return buffer
+    return body
 
 
 @overload
@@ -74,6 +74,56 @@ spec:
         assert dict(result.created_containers[0].environment) \
             .get('MY_ENV') == 'test'
 
+        # イメージの環境変数をコンテナの環境変数で上書きし、コンテナ群を更新
+        manifest = """
+apiVersion: v1
+kind: Hashike
+metadata:
+  namespace: hashike
+  name: test
+spec:
+  containers:
+  - name: hashike-test
+    image: nginx:alpine-slim
+    env:
+    - name: NGINX_VERSION
+      value: overridden
+""".lstrip()
+        result = apply(driver, file=StringIO(manifest), networks=[])
+        assert len(result.created_containers) == 1, result
+        environment = result.created_containers[0].environment
+        assert [x.value for x in environment
+                if x.name == 'NGINX_VERSION'] == ['overridden'], environment
+
+        # 上書きした環境変数は、実行中のコンテナと差分にならない
+        result = apply(driver, file=StringIO(manifest), networks=[])
+        assert not result.removed_containers, result
+        assert not result.created_containers, result
+
+        # 複数要素の command を指定し、コンテナ群を更新
+        manifest = """
+apiVersion: v1
+kind: Hashike
+metadata:
+  namespace: hashike
+  name: test
+spec:
+  containers:
+  - name: hashike-test
+    image: nginx:alpine-slim
+    command: [sh, -c]
+    args: ['exec nginx -g "daemon off;"']
+""".lstrip()
+        result = apply(driver, file=StringIO(manifest), networks=[])
+        assert len(result.removed_containers) == 1, result
+        assert len(result.created_containers) == 1, result
+        assert result.created_containers[0].entrypoint == ('sh', '-c'), result
+
+        # 実行中のコンテナの command と args は、マニフェストと差分にならない
+        result = apply(driver, file=StringIO(manifest), networks=[])
+        assert not result.removed_containers, result
+        assert not result.created_containers, result
+
         # イメージ取得先を docker-archive+s3 に変更し、コンテナ群を更新
         manifest = """
 apiVersion: v1
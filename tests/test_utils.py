@@ -1,4 +1,6 @@
+import copy
 import os
+import pickle
 from pathlib import Path
 from urllib.parse import parse_qs
 
@@ -76,6 +78,39 @@ assert (
     and str(url.path) == '/path/to/service.tar.gz/tmp:latest'
 ), repr(url)
 
+url = utils.URL.create('s3://user:pass@bucket:9000/path/to/file?a=0&b=1')
+assert str(url) == 's3://bucket:9000/path/to/file?a=0&b=1', str(url)
+assert (_ := utils.URL.create(str(url))) == url.replace(username=None,
+                                                        password=None), _
+assert url != url.replace(port=9001)
+assert url != str(url)
+
+for other in (utils.URL.create(url), copy.copy(url), copy.deepcopy(url),
+              pickle.loads(pickle.dumps(url))):
+    assert other == url and hash(other) == hash(url), repr(other)
+
+assert {url: 0}[utils.URL.create(url)] == 0
+assert (_ := url.replace(scheme='file')).scheme == 'file' \
+    and _.path == url.path, repr(_)
+assert repr(url) == (
+    "URL(scheme='s3', username='user', password='pass', hostname='bucket', "
+    "port=9000, path=PurePosixPath('/path/to/file'), query='a=0&b=1')"
+), repr(url)
+
+try:
+    url.replace(unknown=None)
+except TypeError:
+    pass
+else:
+    assert False, 'replace() accepted an unknown field'
+
+try:
+    url.scheme = 'file'  # type: ignore
+except AttributeError:
+    pass
+else:
+    assert False, 'URL is mutable'
+
 if 'S3_MANIFEST_FILE' in os.environ:
     url = utils.URL.create(os.environ['S3_MANIFEST_FILE'])
 